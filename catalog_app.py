@@ -7,20 +7,24 @@ some auxiliary functions
 import json
 import os
 import random
+import sqlite3
 import string
 
 from flask import Flask, render_template, request, redirect, url_for, flash
 from flask import session as login_session
 from flask import jsonify
 from werkzeug.utils import secure_filename
+from jinja2 import FileSystemBytecodeCache
 
-from sqlalchemy import create_engine, desc
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, desc, event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker, joinedload
 from db_setup import Base, Category, Product
 
 from google_auth import make_json_response, generate_state_token
 from google_auth import get_credentials, check_credentials
 from google_auth import get_user_name_and_email, revoke_access
+from job_queue import JobQueue
 
 # Create a Flask application instance
 app = Flask(__name__)
@@ -31,6 +35,20 @@ UPLOAD_FOLDER = app.root_path+'/static/uploads'
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Keep compiled templates on disk so that new workers don't compile them
+TEMPLATE_CACHE_FOLDER = app.root_path+'/.template_cache'
+os.makedirs(TEMPLATE_CACHE_FOLDER, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_FOLDER)
+
+# An id which can't be mistaken for other parts of a url
+URL_ID_PLACEHOLDER = 987654321
+
+# Limits for the batch JSON end points
+BATCH_KEYS = ('create', 'update', 'delete')
+MAX_BATCH_SIZE = 5000
+# SQLite allows at most 999 bound parameters in one statement
+ID_CHUNK_SIZE = 500
+
 # Obtain the client id from "client_secrets.json"
 CLIENT_SEC_FILE = 'client_secrets.json'
 CLIENT_ID = json.loads(open(CLIENT_SEC_FILE, 'r').read())['web']['client_id']
@@ -41,6 +59,10 @@ Base.metadata.bind = engine
 DBSession = sessionmaker(bind=engine)
 session = DBSession()
 
+# Background jobs for side effects of requests
+JOB_DB_FILE = app.root_path+'/jobs.db'
+job_queue = JobQueue(JOB_DB_FILE)
+
 
 # ============================================================================
 # Some helper functions
@@ -68,6 +90,55 @@ def delete_uploaded_file(file_name):
         os.remove(full_name)
 
 
+# Revoke an access token as a background job
+# Only transport errors are raised and retried, a refusal by Google
+# means that the token is already expired or revoked
+def revoke_access_job(access_token):
+    if not revoke_access(access_token):
+        print ("Failed to revoke token for given user")
+
+
+# Queue a background job to run once the current transaction is committed
+def enqueue_after_commit(name, *args):
+    session.info.setdefault('pending_jobs', []).append((name, args))
+
+
+# Hand over the queued jobs after a successful commit
+@event.listens_for(DBSession, 'after_commit')
+def enqueue_pending_jobs(db_session):
+    jobs = db_session.info.pop('pending_jobs', [])
+    if not jobs:
+        return
+
+    # The data is already committed, so the request must not fail here
+    # Files left behind are found by upload_reconciler.py
+    try:
+        job_queue.enqueue_many(jobs)
+    except sqlite3.Error as e:
+        log_to_console(["Failed to queue background jobs: {0}".format(e),
+                        jobs])
+
+
+# Drop the queued jobs of a transaction which was rolled back
+@event.listens_for(DBSession, 'after_rollback')
+def discard_pending_jobs(db_session):
+    db_session.info.pop('pending_jobs', None)
+
+
+# Build a url template for a route with an id, e.g. '/catalog/product/{0}/'
+# Formatting it is much cheaper than calling url_for for every list item
+@app.template_global()
+def url_template(endpoint):
+    return url_for(endpoint, id=URL_ID_PLACEHOLDER) \
+        .replace(str(URL_ID_PLACEHOLDER), '{0}')
+
+
+# Compile all templates before the first request
+def precompile_templates():
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
 # Check if the picture file name is valid
 def allowed_file(filename):
     return '.' in filename and \
@@ -211,8 +282,11 @@ def logout():
             ("User name: {0}".format(login_session['username']))]
     log_to_console(msgs)
 
-    if not revoke_access(access_token):
-        print ("Failed to revoke token for given user")
+    # The token is revoked in the background
+    try:
+        job_queue.enqueue('revoke_access', access_token)
+    except sqlite3.Error as e:
+        print ("Failed to queue token revocation: {0}".format(e))
 
     clear_login_session()
     flash("Logged out", "success")
@@ -240,8 +314,8 @@ def login():
 @app.route("/catalog/")
 def show_home_page():
     categories = session.query(Category).all()
-    products = session.query(Product).order_by(desc(Product.last_updated)). \
-        limit(10)
+    products = session.query(Product).options(joinedload(Product.category)). \
+        order_by(desc(Product.last_updated)).limit(10)
 
     return render_template('home_page.html', categories=categories,
                            products=products)
@@ -481,11 +555,11 @@ def edit_product(id):
         product.description = request.form['description']
         product.category_id = int(request.form['category'])
         session.add(product)
+        # delete the old picture file after the commit
+        if uploaded and old_pic_file:
+            enqueue_after_commit('delete_uploaded_file', old_pic_file)
         session.commit()
 
-        # delete the old picture file
-        if uploaded:
-            delete_uploaded_file(old_pic_file)
         flash("Product updated", "success")
         return redirect(url_for('show_product', id=product.id))
     else:
@@ -513,9 +587,10 @@ def delete_product(id):
         pic_file = product.picture_file
         # delete the selected product
         session.delete(product)
+        # delete the related picture file after the commit
+        if pic_file:
+            enqueue_after_commit('delete_uploaded_file', pic_file)
         session.commit()
-        # delete the related picture file
-        delete_uploaded_file(pic_file)
 
         flash("Product deleted", "success")
         return redirect(url_for('show_category', id=category_id))
@@ -574,8 +649,294 @@ def get_product_json(id):
     return jsonify(Product=result)
 
 
+# Provide the state of the background job queue
+@app.route("/jobs.json/")
+def get_jobs_json():
+    if not user_logged_in():
+        return make_json_response("Login required for this operation", 401)
+
+    return jsonify(Jobs=job_queue.metrics())
+
+
+# =======================================================================
+# Batch JSON
+# Check a batch request and return its data or an error response
+def parse_batch_request():
+    if not user_logged_in():
+        return None, make_json_response("Login required for this operation",
+                                        401)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None, make_json_response("Invalid JSON data", 400)
+
+    total = 0
+    for key in BATCH_KEYS:
+        items = data.get(key, [])
+        if not isinstance(items, list):
+            return None, make_json_response("'{0}' must be a list"
+                                            .format(key), 400)
+        total += len(items)
+
+    if total > MAX_BATCH_SIZE:
+        return None, make_json_response("Batch is limited to {0} items"
+                                        .format(MAX_BATCH_SIZE), 413)
+
+    return data, None
+
+
+# Check if a client supplied value is an id, booleans are not accepted
+def valid_id(value):
+    return type(value) is int
+
+
+# Load objects by their ids with as few queries as possible
+def load_by_ids(model, ids):
+    ids = list(set(id for id in ids if valid_id(id)))
+    objects = {}
+    for i in range(0, len(ids), ID_CHUNK_SIZE):
+        chunk = ids[i:i + ID_CHUNK_SIZE]
+        for obj in session.query(model).filter(model.id.in_(chunk)):
+            objects[obj.id] = obj
+    return objects
+
+
+# Get the id of a batch item, None if it is missing or invalid
+def batch_item_id(item):
+    if isinstance(item, dict):
+        item = item.get('id')
+    return item if valid_id(item) else None
+
+
+# Make a result entry for a batch item
+def batch_result(index, res, id=None):
+    if res != "OK":
+        return dict(index=index, status="error", message=res)
+    return dict(index=index, status="ok", id=id)
+
+
+# Validate product data of a batch item
+# Fields may be omitted for partial updates
+def validate_product_data(item, category_ids, partial=False):
+    if not isinstance(item, dict):
+        return "Item must be a JSON object"
+
+    if not partial or 'name' in item:
+        name = item.get('name')
+        if not isinstance(name, str) or name.strip() == "":
+            return "Product name is empty"
+
+    if not partial or 'description' in item:
+        if not isinstance(item.get('description', ""), str):
+            return "Product description must be a string"
+
+    if not partial or 'category_id' in item:
+        category_id = item.get('category_id')
+        if not valid_id(category_id) or category_id not in category_ids:
+            return "Category not found"
+
+    return "OK"
+
+
+# Validate category data of a batch item against the known category names
+def validate_category_data(item, names, current_id=None):
+    if not isinstance(item, dict):
+        return "Item must be a JSON object"
+
+    name = item.get('name')
+    if not isinstance(name, str) or name.strip() == "":
+        return "Category name is empty"
+
+    name = name.strip()
+    if name in names and names[name] != current_id:
+        return "Category with the name '{0}' already exists".format(name)
+
+    return "OK"
+
+
+# Commit a batch and fill in the ids of created objects
+def commit_batch(created):
+    try:
+        # Flush first so that new ids are known without reloading
+        # every object after the commit
+        session.flush()
+        for result, obj in created:
+            result['id'] = obj.id
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+        return False
+
+    return True
+
+
+# Create, update and delete products in a single transaction
+@app.route("/catalog/product.json/batch/", methods=['POST'])
+def batch_products_json():
+    data, error = parse_batch_request()
+    if error is not None:
+        return error
+
+    category_ids = set(row[0] for row in session.query(Category.id))
+    results = dict(create=[], update=[], delete=[])
+    created = []
+
+    # Create new products
+    for index, item in enumerate(data.get('create', [])):
+        res = validate_product_data(item, category_ids)
+        results['create'].append(batch_result(index, res))
+        if res != "OK":
+            continue
+
+        product = Product(name=item['name'].strip(),
+                          description=item.get('description', ""),
+                          category_id=item['category_id'])
+        session.add(product)
+        created.append((results['create'][-1], product))
+
+    # Update existing products, e.g. move them to another category
+    items = data.get('update', [])
+    products = load_by_ids(Product, [batch_item_id(i) for i in items])
+    for index, item in enumerate(items):
+        product = products.get(batch_item_id(item))
+        if product is None:
+            res = "Product not found"
+        else:
+            res = validate_product_data(item, category_ids, partial=True)
+
+        results['update'].append(batch_result(index, res,
+                                              batch_item_id(item)))
+        if res != "OK":
+            continue
+
+        if 'name' in item:
+            product.name = item['name'].strip()
+        if 'description' in item:
+            product.description = item['description']
+        if 'category_id' in item:
+            product.category_id = item['category_id']
+
+    # Delete products, their pictures are removed after the commit
+    items = data.get('delete', [])
+    products = load_by_ids(Product, [batch_item_id(i) for i in items])
+    for index, item in enumerate(items):
+        product = products.pop(batch_item_id(item), None)
+        res = "OK" if product is not None else "Product not found"
+        results['delete'].append(batch_result(index, res,
+                                              batch_item_id(item)))
+        if res != "OK":
+            continue
+
+        if product.picture_file:
+            enqueue_after_commit('delete_uploaded_file',
+                                 product.picture_file)
+        session.delete(product)
+
+    if not commit_batch(created):
+        return make_json_response("Batch failed, no changes were saved", 500)
+
+    return jsonify(Results=results)
+
+
+# Create, update and delete categories in a single transaction
+@app.route("/catalog/category.json/batch/", methods=['POST'])
+def batch_categories_json():
+    data, error = parse_batch_request()
+    if error is not None:
+        return error
+
+    names = dict((name, id) for id, name in
+                 session.query(Category.id, Category.name))
+    results = dict(create=[], update=[], delete=[])
+    created = []
+
+    # Create new categories
+    for index, item in enumerate(data.get('create', [])):
+        res = validate_category_data(item, names)
+        results['create'].append(batch_result(index, res))
+        if res != "OK":
+            continue
+
+        category = Category(name=item['name'].strip())
+        session.add(category)
+        # The id is not known yet but the name is already taken
+        names[category.name] = category
+        created.append((results['create'][-1], category))
+
+    # Rename existing categories
+    items = data.get('update', [])
+    categories = load_by_ids(Category, [batch_item_id(i) for i in items])
+    for index, item in enumerate(items):
+        category = categories.get(batch_item_id(item))
+        if category is None:
+            res = "Category not found"
+        else:
+            res = validate_category_data(item, names, category.id)
+
+        results['update'].append(batch_result(index, res,
+                                              batch_item_id(item)))
+        if res != "OK":
+            continue
+
+        if names.get(category.name) == category.id:
+            del names[category.name]
+        category.name = item['name'].strip()
+        names[category.name] = category.id
+
+    # Delete empty categories
+    items = data.get('delete', [])
+    categories = load_by_ids(Category, [batch_item_id(i) for i in items])
+    ids = list(categories.keys())
+    not_empty = set()
+    for i in range(0, len(ids), ID_CHUNK_SIZE):
+        query = session.query(Product.category_id) \
+            .filter(Product.category_id.in_(ids[i:i + ID_CHUNK_SIZE])) \
+            .distinct()
+        not_empty.update(row[0] for row in query)
+
+    for index, item in enumerate(items):
+        category = categories.pop(batch_item_id(item), None)
+        if category is None:
+            res = "Category not found"
+        elif category.id in not_empty:
+            res = "Category not empty"
+        else:
+            res = "OK"
+
+        results['delete'].append(batch_result(index, res,
+                                              batch_item_id(item)))
+        if res != "OK":
+            continue
+
+        if names.get(category.name) == category.id:
+            del names[category.name]
+        session.delete(category)
+
+    if not commit_batch(created):
+        return make_json_response("Batch failed, no changes were saved", 500)
+
+    return jsonify(Results=results)
+
+
+# =======================================================================
+# Background jobs and templates
+job_queue.register('delete_uploaded_file', delete_uploaded_file)
+job_queue.register('revoke_access', revoke_access_job, secret=True)
+
+precompile_templates()
+
+
+# Start the background job workers right away
+# Otherwise every process starts them when it queues its first job
+def start_background_jobs():
+    job_queue.start()
+
+
 # =======================================================================
 # Run the application
 if __name__ == '__main__':
     app.debug = True
+    # With the reloader the application runs in a child process
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_jobs()
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module implements a small persistent job queue, so that side effects
+such as file cleanup can run in background threads after a request
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+
+class JobQueue(object):
+    """A job queue stored in an SQLite file and served by worker threads.
+
+    Jobs are handled by functions registered under a name. A job that
+    raises an exception is retried with a growing delay and is moved to
+    the dead letter list after max_attempts failures. The database file
+    is opened on first use, and with autostart the workers are started
+    by the first enqueue in every process.
+    """
+
+    def __init__(self, db_file, workers=2, max_attempts=5, retry_delay=2.0,
+                 poll_interval=1.0, stale_after=600, autostart=True):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.autostart = autostart
+
+        self._db_file = db_file
+        self._conn = None
+        self._conn_pid = None
+        self._pid = None
+        self._handlers = {}
+        self._secret = set()
+        self._threads = []
+        self._running = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(threading.Lock())
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(before=self._before_fork,
+                                after_in_parent=self._lock.release,
+                                after_in_child=self._after_fork)
+
+        # Statistics since the queue was created
+        self._stats = dict(processed=0, retried=0, dead=0,
+                           total_wait=0.0, total_latency=0.0,
+                           max_latency=0.0)
+
+    def __repr__(self):
+        return "JobQueue(%r workers)" % self.workers
+
+    # Open the database on first use, the caller holds the lock
+    # Several processes may share the file, so every claim is a
+    # single conditional update
+    # A forked process opens its own connection
+    def _db(self):
+        if self._conn is not None and self._conn_pid == os.getpid():
+            return self._conn
+
+        conn = sqlite3.connect(self._db_file, timeout=10,
+                               isolation_level=None,
+                               check_same_thread=False)
+        # Arguments such as access tokens are overwritten on deletion
+        conn.execute("PRAGMA secure_delete = ON")
+        conn.execute("""CREATE TABLE IF NOT EXISTS job (
+                      id INTEGER PRIMARY KEY,
+                      name TEXT NOT NULL,
+                      args TEXT NOT NULL,
+                      status TEXT NOT NULL,
+                      attempts INTEGER NOT NULL DEFAULT 0,
+                      created REAL NOT NULL,
+                      run_at REAL NOT NULL,
+                      started REAL,
+                      last_error TEXT)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS job_status_run_at
+                        ON job (status, run_at)""")
+        self._conn = conn
+        self._conn_pid = os.getpid()
+        return conn
+
+    # SQLite connections must not be carried over a fork, so the
+    # connection is closed while no worker uses it and opened again later
+    def _before_fork(self):
+        self._lock.acquire()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # A forked process gets fresh locks and has no worker threads yet
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(threading.Lock())
+        self._threads = []
+        self._running = False
+
+    # Register with a given name
+    # Arguments of secret jobs are not kept in the dead letter list
+    def register(self, name, func, secret=False):
+        self._handlers[name] = func
+        if secret:
+            self._secret.add(name)
+
+    # Add a single job to the queue
+    def enqueue(self, name, *args):
+        self.enqueue_many([(name, args)])
+
+    # Add several (name, args) jobs to the queue in one transaction
+    def enqueue_many(self, jobs):
+        now = time.time()
+        rows = [(name, json.dumps(list(args)), now, now)
+                for name, args in jobs]
+        if not rows:
+            return
+
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("""INSERT INTO job
+                                    (name, args, status, created, run_at)
+                                    VALUES (?, ?, 'queued', ?, ?)""", rows)
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                # Leave the connection usable for later jobs
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+
+        if self.autostart and self._pid != os.getpid():
+            self.start()
+        with self._wakeup:
+            self._wakeup.notify(len(rows))
+
+    # Start the worker threads of the current process
+    # Threads are not copied by fork, so a forked process starts its own
+    def start(self):
+        if self._running and self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._requeue_stale()
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name="job-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    # Stop the worker threads after their current jobs
+    def stop(self):
+        self._running = False
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    # Run all jobs which are due in the calling thread
+    def run_pending(self):
+        count = 0
+        while self._run_one():
+            count += 1
+        return count
+
+    # Provide queue depth and latency figures
+    def metrics(self):
+        with self._lock:
+            counts = dict(self._db().execute("""SELECT status, COUNT(*)
+                                                FROM job GROUP BY status"""))
+            oldest = self._db().execute("""SELECT MIN(created) FROM job
+                                           WHERE status = 'queued'""") \
+                .fetchone()[0]
+            stats = dict(self._stats)
+
+        processed = stats['processed']
+        return {"queued": counts.get('queued', 0),
+                "running": counts.get('running', 0),
+                "dead": counts.get('dead', 0),
+                "processed": processed,
+                "retried": stats['retried'],
+                "oldest_queued_age": (time.time() - oldest
+                                      if oldest is not None else 0.0),
+                "avg_wait": (stats['total_wait'] / processed
+                             if processed else 0.0),
+                "avg_latency": (stats['total_latency'] / processed
+                                if processed else 0.0),
+                "max_latency": stats['max_latency']}
+
+    # List the jobs which failed too many times
+    def dead_letters(self):
+        with self._lock:
+            rows = self._db().execute("""SELECT id, name, args, attempts,
+                                         last_error FROM job
+                                         WHERE status = 'dead'
+                                         ORDER BY id""").fetchall()
+        return [{"id": id, "name": name, "args": json.loads(args),
+                 "attempts": attempts, "error": error}
+                for id, name, args, attempts, error in rows]
+
+    # Put dead jobs back into the queue, unless their arguments are cleared
+    def retry_dead(self):
+        with self._lock:
+            cur = self._db().execute("""UPDATE job SET status = 'queued',
+                                        attempts = 0, run_at = ?
+                                        WHERE status = 'dead'
+                                        AND args != 'null'""",
+                                     (time.time(), ))
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return cur.rowcount
+
+    # Jobs left running by a dead process are queued again
+    def _requeue_stale(self):
+        with self._lock:
+            self._db().execute("""UPDATE job SET status = 'queued'
+                                  WHERE status = 'running' AND started < ?""",
+                               (time.time() - self.stale_after, ))
+
+    # Main loop of a worker thread
+    # Database errors are logged and the worker waits before trying again,
+    # jobs left running by such an error are queued again later
+    def _work(self):
+        while self._running:
+            try:
+                busy = self._run_one()
+                if not busy:
+                    self._requeue_stale()
+            except sqlite3.Error as e:
+                print ("Job queue error: {0}".format(e))
+                busy = False
+
+            if not busy:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+
+    # Claim the next due job, returns None if there is nothing to do
+    def _claim(self):
+        now = time.time()
+        with self._lock:
+            while True:
+                row = self._db().execute("""SELECT id, name, args, attempts,
+                                            created FROM job
+                                            WHERE status = 'queued'
+                                            AND run_at <= ?
+                                            ORDER BY run_at, id LIMIT 1""",
+                                         (now, )).fetchone()
+                if row is None:
+                    return None
+
+                cur = self._db().execute("""UPDATE job SET status = 'running',
+                                            started = ? WHERE id = ?
+                                            AND status = 'queued'""",
+                                         (now, row[0]))
+                # Another process may have claimed the job first
+                if cur.rowcount == 1:
+                    return row
+
+    # Run a single job, returns False if no job was due
+    def _run_one(self):
+        row = self._claim()
+        if row is None:
+            return False
+
+        id, name, args, attempts, created = row
+        started = time.time()
+        try:
+            handler = self._handlers.get(name)
+            if handler is None:
+                raise LookupError("No handler for job '%s'" % name)
+            handler(*json.loads(args))
+        except Exception:
+            self._fail(id, name, attempts + 1, traceback.format_exc())
+            return True
+
+        finished = time.time()
+        with self._lock:
+            self._db().execute("DELETE FROM job WHERE id = ?", (id, ))
+            self._stats['processed'] += 1
+            self._stats['total_wait'] += started - created
+            self._stats['total_latency'] += finished - created
+            self._stats['max_latency'] = max(self._stats['max_latency'],
+                                             finished - created)
+        return True
+
+    # Schedule a retry or move a failed job to the dead letter list
+    def _fail(self, id, name, attempts, error):
+        with self._lock:
+            if attempts >= self.max_attempts:
+                args = 'null' if name in self._secret else None
+                self._db().execute("""UPDATE job SET status = 'dead',
+                                      attempts = ?, last_error = ?,
+                                      args = COALESCE(?, args)
+                                      WHERE id = ?""",
+                                   (attempts, error, args, id))
+                self._stats['dead'] += 1
+            else:
+                run_at = time.time() + self.retry_delay * 2 ** (attempts - 1)
+                self._db().execute("""UPDATE job SET status = 'queued',
+                                      attempts = ?, run_at = ?,
+                                      last_error = ? WHERE id = ?""",
+                                   (attempts, run_at, error, id))
+                self._stats['retried'] += 1
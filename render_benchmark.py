@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module measures how long the list pages take to render
+
+Usage: python3 render_benchmark.py [--repeat N]
+"""
+import argparse
+import timeit
+
+from flask import render_template
+from flask import session as login_session
+
+from catalog_app import app
+from db_setup import Category, Product
+
+PAGE_SIZES = (10, 1000, 10000)
+
+
+# Make a category with a given number of products, half of them with pictures
+# The objects are never added to the database
+def make_products(count):
+    category = Category("Benchmark")
+    category.id = 1
+    products = []
+    for i in range(count):
+        picture_file = "%012d.png" % i if i % 2 == 0 else ""
+        product = Product("Product %d" % i, "Description", category.id,
+                          picture_file)
+        product.id = i + 1
+        product.category = category
+        products.append(product)
+    return category, products
+
+
+# Render the home page and the category page for every page size
+def run_benchmark(repeat=5, logged_in=True):
+    results = []
+    with app.test_request_context('/'):
+        if logged_in:
+            login_session['username'] = "Benchmark"
+
+        for size in PAGE_SIZES:
+            category, products = make_products(size)
+            pages = [('home_page.html', dict(categories=[category],
+                                             products=products)),
+                     ('category.html', dict(category=category,
+                                            products=products))]
+            for template, params in pages:
+                best = min(timeit.repeat(
+                    lambda: render_template(template, **params),
+                    number=1, repeat=repeat))
+                results.append((template, size, best))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of renders per page, the best is shown")
+    args = parser.parse_args()
+
+    print ("\n**********************************")
+    for template, size, seconds in run_benchmark(args.repeat):
+        print ("{0:<16} {1:>6} products: {2:8.2f} ms".format(
+               template, size, seconds * 1000))
+    print ("**********************************")
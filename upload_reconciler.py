@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module compares the uploaded picture files with the product records
+and finds orphaned files, dangling references and storage usage per category
+
+Usage: python3 upload_reconciler.py [--delete] [--fix] [--min-age SECONDS]
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+DB_FILE = os.path.join(APP_FOLDER, 'catalog.db')
+UPLOAD_FOLDER = os.path.join(APP_FOLDER, 'static', 'uploads')
+
+# Number of directory entries inserted at a time
+SCAN_BATCH_SIZE = 10000
+# Number of dangling references cleared in one transaction
+FIX_BATCH_SIZE = 500
+
+
+# Open the catalog database with temporary tables for the upload listing
+# and a copy of the picture references. Both are kept by SQLite, so
+# neither side is held in memory, and the joins run on the temporary
+# tables only, so the application can write while files are deleted
+def open_database(db_file):
+    conn = sqlite3.connect(db_file)
+    conn.execute("""CREATE TEMP TABLE upload (
+                      name TEXT NOT NULL,
+                      size INTEGER NOT NULL,
+                      mtime REAL NOT NULL)""")
+    conn.execute("""CREATE TEMP TABLE picture (
+                      product_id INTEGER NOT NULL,
+                      category_id INTEGER,
+                      name TEXT NOT NULL)""")
+    conn.execute("""CREATE TEMP TABLE category_copy (
+                      id INTEGER NOT NULL,
+                      name TEXT)""")
+    return conn
+
+
+# Copy the picture references and categories in one short read
+# The covering index lets the joins run on the index alone
+def copy_references(conn):
+    conn.execute("""INSERT INTO picture
+                    SELECT id, category_id, picture_file FROM main.product
+                    WHERE picture_file IS NOT NULL
+                    AND picture_file != ''""")
+    conn.execute("""INSERT INTO category_copy
+                    SELECT id, name FROM main.category""")
+    conn.commit()
+    conn.execute("""CREATE INDEX temp.picture_name
+                    ON picture (name, category_id, product_id)""")
+    conn.commit()
+
+
+# Walk the upload folder and record every file in the upload table
+# The index is built once after loading, which is faster than keeping
+# it up to date for every row
+def scan_uploads(conn, upload_folder):
+    count = 0
+    batch = []
+    for entry in os.scandir(upload_folder):
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        stat = entry.stat(follow_symlinks=False)
+        batch.append((entry.name, stat.st_size, stat.st_mtime))
+        if len(batch) >= SCAN_BATCH_SIZE:
+            conn.executemany("INSERT INTO upload VALUES (?, ?, ?)", batch)
+            count += len(batch)
+            batch = []
+
+    conn.executemany("INSERT INTO upload VALUES (?, ?, ?)", batch)
+    conn.execute("""CREATE UNIQUE INDEX temp.upload_name
+                    ON upload (name, size, mtime)""")
+    conn.commit()
+    return count + len(batch)
+
+
+# Yield (name, size, mtime, category id, product id) of every file
+# The ids are None for files which no product refers to. Walking both
+# indexes in name order keeps the lookups local
+def walk_uploads(conn):
+    return conn.execute("""SELECT upload.name, upload.size, upload.mtime,
+                           picture.category_id, picture.product_id
+                           FROM upload LEFT JOIN picture
+                           ON picture.name = upload.name
+                           ORDER BY upload.name""")
+
+
+# Yield (product id, picture file) of products whose picture is missing
+def find_dangling(conn):
+    return conn.execute("""SELECT product_id, name FROM picture
+                           WHERE NOT EXISTS
+                           (SELECT 1 FROM upload
+                            WHERE upload.name = picture.name)
+                           ORDER BY product_id""")
+
+
+# Clear the given (product id, picture file) references, so that the
+# place holder image is shown. The application may have changed a product
+# or saved its file since the scan, so both are checked again
+# Short transactions keep the application able to write meanwhile
+def fix_dangling(conn, upload_folder, dangling):
+    fixed = 0
+    for i in range(0, len(dangling), FIX_BATCH_SIZE):
+        missing = [(id, picture_file) for id, picture_file
+                   in dangling[i:i + FIX_BATCH_SIZE]
+                   if not os.path.isfile(os.path.join(upload_folder,
+                                                      picture_file))]
+        for id, picture_file in missing:
+            cur = conn.execute("""UPDATE main.product SET picture_file = ''
+                                  WHERE id = ? AND picture_file = ?""",
+                               (id, picture_file))
+            fixed += cur.rowcount
+        conn.commit()
+    return fixed
+
+
+# Provide the number and size of picture files for each category
+# usage maps a category id to a [files, bytes] pair
+def category_usage(conn, usage):
+    rows = conn.execute("""SELECT id, name FROM category_copy
+                           ORDER BY id""")
+    return [dict(id=id, name=name, files=usage.get(id, [0, 0])[0],
+                 bytes=usage.get(id, [0, 0])[1])
+            for id, name in rows]
+
+
+# Compare the database and the upload folder and report the results
+# Orphaned files are deleted and dangling references cleared on request
+def reconcile(db_file=DB_FILE, upload_folder=UPLOAD_FOLDER, delete=False,
+              fix=False, min_age=3600, log=print):
+    conn = open_database(db_file)
+    try:
+        # References are copied after the scan, so that a file saved by
+        # the application meanwhile is never taken for an orphan
+        report = dict(files=scan_uploads(conn, upload_folder),
+                      orphans=0, orphan_bytes=0, deleted=0,
+                      dangling=0, fixed=0)
+        copy_references(conn)
+
+        # Files younger than min_age may belong to a request in progress
+        max_mtime = time.time() - min_age
+        usage = {}
+        dangling = []
+        for name, size, mtime, category_id, product_id in walk_uploads(conn):
+            if product_id is not None:
+                totals = usage.setdefault(category_id, [0, 0])
+                totals[0] += 1
+                totals[1] += size
+                continue
+            if mtime >= max_mtime:
+                continue
+
+            report['orphans'] += 1
+            report['orphan_bytes'] += size
+            log("Orphaned file: {0} ({1} bytes)".format(name, size))
+            if delete:
+                try:
+                    os.remove(os.path.join(upload_folder, name))
+                    report['deleted'] += 1
+                except OSError as e:
+                    log("Failed to delete {0}: {1}".format(name, e))
+
+        for id, picture_file in find_dangling(conn):
+            report['dangling'] += 1
+            if fix:
+                dangling.append((id, picture_file))
+            log("Missing picture of product {0}: {1}"
+                .format(id, picture_file))
+
+        if dangling:
+            report['fixed'] = fix_dangling(conn, upload_folder, dangling)
+
+        report['categories'] = category_usage(conn, usage)
+    finally:
+        conn.close()
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--delete', action='store_true',
+                        help="delete orphaned files")
+    parser.add_argument('--fix', action='store_true',
+                        help="clear references to missing files")
+    parser.add_argument('--min-age', type=int, default=3600,
+                        help="ignore files younger than this (seconds)")
+    args = parser.parse_args()
+
+    start = time.time()
+    report = reconcile(delete=args.delete, fix=args.fix,
+                       min_age=args.min_age)
+
+    print ("\n**********************************")
+    print ("Files scanned: {0}".format(report['files']))
+    print ("Orphaned files: {0} ({1} bytes), deleted: {2}".format(
+           report['orphans'], report['orphan_bytes'], report['deleted']))
+    print ("Dangling references: {0}, fixed: {1}".format(
+           report['dangling'], report['fixed']))
+    for cat in report['categories']:
+        print ("Category {0} '{1}': {2} files, {3} bytes".format(
+               cat['id'], cat['name'], cat['files'], cat['bytes']))
+    print ("Finished in {0:.2f} seconds".format(time.time() - start))
+    print ("**********************************")